@@ -16,10 +16,13 @@ except ImportError:
 	# Python 2
 	import ConfigParser
 
-import hashlib
 import os
 import sys
 
+from mergeutil import (externalsort, groupsorted, readscheduled, readBatch,
+		hashfile, Throttle, lowerIOPriority, RecordWriter, WalkFilter, patternList,
+		walkfiles)
+
 
 def _getDevelopmentVersion():
 	try:
@@ -59,38 +62,55 @@ def dupdict(seq):
 	return d
 
 
-def listdup(dirname, minsize=1):
-	'''Print files that are duplicated within the directory.'''
-	filesizes = []
-	for root, dirs, files in os.walk(dirname):
-		for name in files:
-			filename = os.path.abspath(os.path.join(root, name) )
-			size = os.stat(filename).st_size
-			filesizes.append( (size, filename) )
-	d = dupdict(filesizes)
-	sig = []
-	for size, filenames in d.items():
-		if size < minsize or len(filenames) < 2: continue
-		for filename in filenames:
-			try:
-				f = open(filename, 'rb')
-			except IOError:
-				# Can happen if the file is deleted during the script run,
-				# or if a link points to a non-existent file
-				continue
-			m = hashlib.sha256()
-			while True:
-				data = f.read(1048576)
-				if not data:
-					break
-				m.update(data)
-			f.close()
-			sig.append( (m.hexdigest(), filename) )
-	dupsigs = dupdict(sig)
-	for sig, filenames in dupsigs.items():
+def listdup(dirname, minsize=1, maxmemory=0, tmpdir=None, maxreaders=0,
+		throttle=None, output=None, walkfilter=None):
+	'''Print files that are duplicated within the directory.  If maxmemory
+	is nonzero, find the duplicates by sorting the file sizes and signatures
+	on disk in tmpdir, using about maxmemory bytes of memory for each sort.
+	Files are hashed in batches ordered by readscheduled, with maxreaders
+	concurrent reads per device, and read through throttle if it is given.
+	If output is given, each group of duplicates is written to that
+	RecordWriter with its size, signature and paths relative to dirname,
+	except that a 'null' RecordWriter is given only the absolute paths of
+	the redundant copies: all but the first path of each group in sorted
+	order.  Files rejected by walkfilter, or smaller than minsize, are
+	skipped during the directory walk.
+	'''
+	def filesizes():
+		for filename, st in walkfiles(dirname, walkfilter, minsize):
+			yield (st.st_size, (filename, st) )
+	def readsig(filename, st):
+		digest = hashfile(filename, throttle)
+		if digest is None:
+			return None
+		return ( (st.st_size, digest), filename)
+	def signatures(groups):
+		pending = []
+		for size, files in groups:
+			if size < minsize or len(files) < 2: continue
+			pending.extend(files)
+			if len(pending) >= readBatch:
+				for sig in readscheduled(pending, readsig, maxreaders):
+					yield sig
+				pending = []
+		for sig in readscheduled(pending, readsig, maxreaders):
+			yield sig
+	def groupby(seq):
+		if maxmemory:
+			return groupsorted(externalsort(seq, maxmemory, tmpdir) )
+		return dupdict(seq).items()
+	dupsigs = groupby(signatures(groupby(filesizes() ) ) )
+	for sig, filenames in dupsigs:
 		if len(filenames) < 2: continue
-		print( '"' + '" = "'.join(filenames)  + '"')
-
+		if output and output.format == 'null':
+			# Only the redundant copies, so the list can be passed to xargs -0
+			# without losing the first file (in sorted order) of each group
+			output.write({'paths': sorted(filenames)[1:]})
+		elif output:
+			output.write({'size': sig[0], 'digest': sig[1],
+					'paths': [os.path.relpath(x, dirname) for x in filenames]})
+		else:
+			print( '"' + '" = "'.join(filenames)  + '"')
 
 
 log = logging.getLogger(__name__)
@@ -191,6 +211,40 @@ def run_cli(argv=None):
 	clparser.add_option('--min', dest='minsize', metavar='SIZE',
 			help='Set minimum size to search for identical files (default 1; 0 means any file size)',
 			type='int')
+	clparser.add_option('--max', dest='maxsize', metavar='SIZE',
+			help='Set maximum size of files to search for identical files (default no limit)',
+			type='int')
+	clparser.add_option('--include', dest='include', metavar='GLOB', action='append',
+			help='Only search files matching GLOB; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--exclude', dest='exclude', metavar='GLOB', action='append',
+			help='Do not search files or directories matching GLOB; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--include-regex', dest='includeregex', metavar='REGEX', action='append',
+			help='Only search files whose relative path matches REGEX; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--exclude-regex', dest='excluderegex', metavar='REGEX', action='append',
+			help='Do not search files or directories whose relative path matches REGEX; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('-x', '--xdev', dest='xdev', action='store_true',
+			help='Do not search directories on other file systems')
+	clparser.add_option('--skip-special', dest='skipspecial', action='store_true',
+			help='Do not search files that are not regular files, such as devices and pipes')
+	clparser.add_option('--max-memory', dest='maxmemory', metavar='MB',
+			help='Limit memory used to group files to about MB megabytes by sorting on disk (default 0; 0 means no limit)',
+			type='int')
+	clparser.add_option('--tmpdir', dest='tmpdir', metavar='DIR',
+			help='Set directory for temporary files written when --max-memory is given')
+	clparser.add_option('--readers', dest='maxreaders', metavar='NUM',
+			help='Set number of files read at once from each device (default 0; 0 means 1 for spinning disks and 4 for solid state devices)',
+			type='int')
+	clparser.add_option('--background', dest='background', action='store_true',
+			help='Drop scanned files from the page cache and lower the I/O priority, to run alongside other programs')
+	clparser.add_option('--max-rate', dest='maxrate', metavar='MB',
+			help='Limit reading files to MB megabytes per second (default 0; 0 means no limit)',
+			type='float')
+	clparser.add_option('--max-iops', dest='maxiops', metavar='NUM',
+			help='Limit reading files to NUM reads per second (default 0; 0 means no limit)',
+			type='float')
+	clparser.add_option('--format', dest='format', metavar='FORMAT',
+			help='Set output format: text, ndjson (one JSON object per group of duplicates; if any path is not valid UTF-8, the raw bytes of all paths are added base64 encoded in paths_b64) or null (absolute path of each redundant copy followed by a NUL character, for xargs -0: every file of each group except the first in sorted order, which is kept off the list; use ndjson to see whole groups) (default text)',
+			type='choice', choices=['text', 'ndjson', 'null'])
 	clparser.set_defaults(filename = _qualname_ + '.cfg')
 	(options, args) = clparser.parse_args(argv)
 	
@@ -257,7 +311,31 @@ def run_cli(argv=None):
 	
 	kwargs = {}
 	if o['minsize'] != None: kwargs['minsize'] = o['minsize']
-	listdup(*args, **kwargs)
+	if o['maxmemory']: kwargs['maxmemory'] = int(o['maxmemory']) * 1048576
+	if o['tmpdir']: kwargs['tmpdir'] = o['tmpdir']
+	if o['maxreaders']: kwargs['maxreaders'] = int(o['maxreaders'])
+	if o['background'] and not lowerIOPriority():
+		log.warning('Unable to lower the I/O priority on this system')
+	if o['background'] or o['maxrate'] or o['maxiops']:
+		kwargs['throttle'] = Throttle(float(o['maxrate'] or 0) * 1048576,
+				float(o['maxiops'] or 0), bool(o['background']) )
+	if (o['maxsize'] != None or o['include'] or o['exclude'] or o['includeregex']
+			or o['excluderegex'] or o['xdev'] or o['skipspecial']):
+		if o['maxsize'] != None:
+			maxsize = int(o['maxsize'])
+		else:
+			maxsize = None
+		kwargs['walkfilter'] = WalkFilter(patternList(o['include']),
+				patternList(o['exclude']), patternList(o['includeregex']),
+				patternList(o['excluderegex']), maxsize,
+				bool(o['xdev']), bool(o['skipspecial']) )
+	if o['format'] and o['format'] != 'text':
+		kwargs['output'] = RecordWriter(o['format'])
+	try:
+		listdup(*args, **kwargs)
+	finally:
+		if 'output' in kwargs:
+			kwargs['output'].flush()
 	return 0
 
 
@@ -0,0 +1,625 @@
+# File encoding: utf-8, indentation: tabs
+'''Shared machinery for listdup and rmerge: walking directory trees,
+scheduling and throttling file reads, grouping records that may not fit in
+memory, and writing machine-readable output
+'''
+# Simplify support for Python 2.5 with some __future__ imports
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import with_statement
+
+import hashlib
+import os
+import shutil
+import sys
+try:
+	import fcntl
+except ImportError:
+	# Windows
+	fcntl = None
+
+
+def _recordSize(record):
+	'''Estimate the number of bytes of memory used by a record tuple, including
+	the items of any tuples nested within it.
+	'''
+	size = sys.getsizeof(record)
+	for item in record:
+		if isinstance(item, tuple):
+			size += _recordSize(item)
+		else:
+			size += sys.getsizeof(item)
+	return size
+
+
+def _writeRun(records, dirname):
+	'''Write the already sorted records to a new run file in directory dirname
+	and return the name of the file.
+	'''
+	import pickle
+	import tempfile
+	fd, runname = tempfile.mkstemp(suffix='.run', dir=dirname)
+	f = os.fdopen(fd, 'wb')
+	try:
+		for record in records:
+			pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+	finally:
+		f.close()
+	return runname
+
+
+def _readRun(runname):
+	'''Generate the records stored in a run file written by _writeRun.'''
+	import pickle
+	f = open(runname, 'rb')
+	try:
+		while True:
+			try:
+				yield pickle.load(f)
+			except EOFError:
+				break
+	finally:
+		f.close()
+
+
+def _mergeRuns(runs, dirname):
+	'''Merge the run files runs into a new run file in directory dirname,
+	remove them, and return the name of the new file.
+	'''
+	import heapq
+	merged = _writeRun(heapq.merge(*[_readRun(x) for x in runs]), dirname)
+	for x in runs:
+		os.remove(x)
+	return merged
+
+
+# Maximum number of run files merged at once, to stay well below the limit
+# on the number of open files
+_mergeWidth = 64
+def externalsort(seq, maxmemory, tmpdir=None):
+	'''Generate the items of seq in sorted order while holding only about
+	maxmemory bytes of them in memory at once.  Whenever the ceiling is
+	reached, the items held are sorted and spilled to a run file in a
+	temporary directory created within tmpdir, and the runs are merged back
+	together as the sorted items are generated.
+	'''
+	import heapq
+	import tempfile
+	rundir = None
+	# levels[n] holds the runs made by merging _mergeWidth runs of level n - 1,
+	# so that each record is rewritten only once per level
+	levels = [[]]
+	records = []
+	used = 0
+	try:
+		for record in seq:
+			records.append(record)
+			used += _recordSize(record)
+			if used < maxmemory:
+				continue
+			if rundir is None:
+				rundir = tempfile.mkdtemp(prefix='mergetools-', dir=tmpdir)
+			records.sort()
+			levels[0].append(_writeRun(records, rundir) )
+			records = []
+			used = 0
+			level = 0
+			while len(levels[level]) >= _mergeWidth:
+				if level + 1 == len(levels):
+					levels.append([])
+				levels[level + 1].append(_mergeRuns(levels[level], rundir) )
+				levels[level] = []
+				level += 1
+		# Runs of the lowest levels are the smallest, so merge those first
+		# if there are too many runs left to merge at once
+		runs = []
+		for level in levels:
+			runs.extend(level)
+		while len(runs) >= _mergeWidth:
+			runs = runs[_mergeWidth:] + [_mergeRuns(runs[:_mergeWidth], rundir)]
+		records.sort()
+		for record in heapq.merge(records, *[_readRun(x) for x in runs]):
+			yield record
+	finally:
+		if rundir is not None:
+			shutil.rmtree(rundir, ignore_errors=True)
+
+
+def groupsorted(seq):
+	'''Transform a sorted sequence of 2-tuples into a generator of 2-tuples,
+	one for each distinct first element, with that element and a list of all
+	the second elements stored with it.  This is the streaming equivalent of
+	dupdict(seq).items() for input that has been sorted by externalsort.
+	'''
+	import itertools
+	import operator
+	for key, pairs in itertools.groupby(seq, operator.itemgetter(0) ):
+		yield key, [pair[1] for pair in pairs]
+
+
+def mergejoin(seqA, seqB):
+	'''Return a generator of 3-tuples for each key present in both of the
+	grouped sequences seqA and seqB, as generated by groupsorted, containing
+	the key and the values stored with it in seqA and in seqB.
+	'''
+	seqA = iter(seqA)
+	seqB = iter(seqB)
+	try:
+		a = next(seqA)
+		b = next(seqB)
+		while True:
+			if a[0] < b[0]:
+				a = next(seqA)
+			elif b[0] < a[0]:
+				b = next(seqB)
+			else:
+				yield a[0], a[1], b[1]
+				a = next(seqA)
+				b = next(seqB)
+	except StopIteration:
+		return
+
+
+# ioctl request number and structure layout of the linux FIEMAP interface,
+# used to find where the data of a file is stored on its device
+_FS_IOC_FIEMAP = 0xC020660B
+_fiemapHeader = '=QQLLLL'
+_fiemapExtentSize = 56
+def _physicalOffset(fd):
+	'''Return the physical byte offset of the first extent of the open file
+	descriptor fd on its device, or None if the file has no extents.  Raise
+	IOError or OSError if the file system does not support FIEMAP.
+	'''
+	import struct
+	headerSize = struct.calcsize(_fiemapHeader)
+	buf = bytearray(headerSize + _fiemapExtentSize)
+	struct.pack_into(_fiemapHeader, buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+	fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf, True)
+	if struct.unpack_from('=L', buf, 20)[0] == 0:
+		return None
+	return struct.unpack_from('=Q', buf, headerSize + 8)[0]
+
+
+def _rotational(dev):
+	'''Return True if device dev is a spinning disk, False if it is a solid
+	state device, or None if that cannot be determined.
+	'''
+	try:
+		sysdir = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev) )
+	except AttributeError:
+		return None
+	# Partitions have no queue directory of their own; use the parent disk's
+	for queue in (os.path.join(sysdir, 'queue'), os.path.join(sysdir, '..', 'queue') ):
+		try:
+			with open(os.path.join(queue, 'rotational') ) as f:
+				return f.read().strip() != '0'
+		except IOError:
+			pass
+	return None
+
+
+def _readers(rotational):
+	'''Return the number of files to read at once from a device for which
+	_rotational returned rotational: one for spinning disks (or when the
+	device type is unknown), where concurrent reads only add seeks, and
+	several for solid state devices.
+	'''
+	if rotational is False:
+		return 4
+	return 1
+
+
+def schedulereads(files):
+	'''Return a list of 3-tuples, one for each device holding any of the
+	files given as (filename, stat) tuples, containing the device number,
+	the result of _rotational for it, and a list of the (filename, stat)
+	tuples for the files on that device.  Each list is ordered by inode
+	number; on devices that may be spinning disks it is ordered instead by
+	the physical location of the files where FIEMAP reports it, so that
+	reading the files in that order keeps seeking low.
+	'''
+	devices = {}
+	for filename, st in files:
+		devices.setdefault(st.st_dev, []).append( (filename, st) )
+	schedule = []
+	for dev, entries in devices.items():
+		rotational = _rotational(dev)
+		keyed = []
+		usefiemap = fcntl is not None and rotational is not False
+		for filename, st in entries:
+			offset = None
+			if usefiemap:
+				try:
+					f = open(filename, 'rb')
+				except IOError:
+					# Can happen if the file is deleted during the script run
+					continue
+				try:
+					try:
+						offset = _physicalOffset(f.fileno() )
+					except (IOError, OSError):
+						usefiemap = False
+				finally:
+					f.close()
+			if offset is None:
+				key = (1, st.st_ino)
+			else:
+				key = (0, offset)
+			keyed.append( (key, filename, st) )
+		keyed.sort()
+		schedule.append( (dev, rotational, [(filename, st) for key, filename, st in keyed]) )
+	return schedule
+
+
+def readscheduled(files, readfile, maxreaders=0):
+	'''Call readfile(filename, stat) for each of the (filename, stat) tuples
+	in files, in the order given by schedulereads, and return a list of the
+	results that are not None.
+	Each device is read by its own threads, maxreaders of them or, if
+	maxreaders is 0, as many as suit the kind of device.
+	'''
+	import threading
+	results = []
+	errors = []
+	lock = threading.Lock()
+	def reader(entries):
+		while not errors:
+			with lock:
+				try:
+					filename, st = next(entries)
+				except StopIteration:
+					return
+			try:
+				result = readfile(filename, st)
+			except Exception:
+				errors.append(sys.exc_info()[1])
+				return
+			if result is not None:
+				results.append(result)
+	threads = []
+	for dev, rotational, entries in schedulereads(files):
+		entries = iter(entries)
+		for i in range(maxreaders or _readers(rotational) ):
+			t = threading.Thread(target=reader, args=(entries,) )
+			t.daemon = True
+			t.start()
+			threads.append(t)
+	for t in threads:
+		t.join()
+	if errors:
+		raise errors[0]
+	return results
+
+
+readSize = 1048576
+def hashfile(filename, throttle=None):
+	'''Return the sha256 hash of the contents of file filename as a hex
+	string, or None if the file cannot be opened.  The kernel is advised that
+	the file will be read sequentially, and asked to prefetch each block
+	while the previous one is being hashed.  If throttle is given, the file
+	is read through it.
+	'''
+	try:
+		f = open(filename, 'rb')
+	except IOError:
+		# Can happen if the file is deleted during the script run,
+		# or if a link points to a non-existent file
+		return None
+	fadvise = getattr(os, 'posix_fadvise', None)
+	try:
+		fd = f.fileno()
+		if fadvise:
+			fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		m = hashlib.sha256()
+		offset = 0
+		while True:
+			if fadvise:
+				fadvise(fd, offset, 2 * readSize, os.POSIX_FADV_WILLNEED)
+			if throttle:
+				data = throttle.read(f, offset, readSize)
+			else:
+				data = f.read(readSize)
+			if not data:
+				break
+			m.update(data)
+			offset += len(data)
+	finally:
+		f.close()
+	return m.hexdigest()
+
+
+class Throttle(object):
+	'''Limit reads to maxrate bytes and maxiops reads per second (0 means no
+	limit), with a token bucket for each that holds at most one second's
+	worth of tokens.  If dropcache is True, pages are dropped from the page
+	cache once they have been read, so that a scan does not evict the
+	working set of other programs.
+	'''
+	def __init__(self, maxrate=0, maxiops=0, dropcache=False):
+		import threading
+		import time
+		self.maxrate = maxrate
+		self.maxiops = maxiops
+		self.dropcache = dropcache and hasattr(os, 'posix_fadvise')
+		self._clock = getattr(time, 'monotonic', time.time)
+		self._lock = threading.Lock()
+		self._last = self._clock()
+		self._bytes = maxrate
+		self._iops = maxiops
+	
+	def consume(self, nbytes):
+		'''Take one read of nbytes bytes from the buckets, sleeping for as
+		long as the buckets are in debt afterwards.
+		'''
+		import time
+		delay = 0
+		with self._lock:
+			now = self._clock()
+			elapsed = now - self._last
+			self._last = now
+			if self.maxrate:
+				self._bytes = min(self.maxrate, self._bytes + elapsed * self.maxrate) - nbytes
+				if self._bytes < 0:
+					delay = -self._bytes / self.maxrate
+			if self.maxiops:
+				self._iops = min(self.maxiops, self._iops + elapsed * self.maxiops) - 1
+				if self._iops < 0:
+					delay = max(delay, -self._iops / self.maxiops)
+		if delay:
+			time.sleep(delay)
+	
+	def read(self, f, offset, size):
+		'''Read up to size bytes from file object f, whose position is offset,
+		within the limits of the throttle.  The empty read at the end of the
+		file is not charged.
+		'''
+		data = f.read(size)
+		if not data:
+			return data
+		self.consume(len(data) )
+		if self.dropcache:
+			os.posix_fadvise(f.fileno(), offset, len(data), os.POSIX_FADV_DONTNEED)
+		return data
+
+
+# ioprio_set system call numbers on linux, by machine architecture
+_ioprioSyscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+		'armv7l': 314, 'ppc64le': 273, 'riscv64': 30}
+def lowerIOPriority():
+	'''Put this process in the best effort I/O scheduling class at its lowest
+	priority, so that its reads yield to those of other programs.  Return
+	False if that is not supported on this system.
+	'''
+	import platform
+	nr = _ioprioSyscalls.get(platform.machine() )
+	if nr is None or not sys.platform.startswith('linux'):
+		return False
+	try:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+	except (ImportError, OSError):
+		return False
+	IOPRIO_WHO_PROCESS = 1
+	IOPRIO_CLASS_BE = 2
+	IOPRIO_CLASS_SHIFT = 13
+	return libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 7) == 0
+
+
+class RecordWriter(object):
+	'''Write result records (dicts) to stream, or to standard output if stream
+	is None, in a machine-readable format.  The 'ndjson' format writes each
+	record as one line of JSON; a path field (one named in pathFields) that
+	is not valid UTF-8 is written with undecodable bytes replaced, and its
+	raw bytes are added base64 encoded in a field of the same name followed
+	by '_b64'.  The 'null' format writes each path in a record followed by
+	a NUL character, making a flat list suitable for xargs -0, so callers
+	should only give it the paths that list is meant for.  Output is
+	collected and written in batches of about bufsize bytes; call flush when
+	done.
+	'''
+	formats = ('ndjson', 'null')
+	pathFields = ('path', 'paths', 'match')
+	def __init__(self, format, stream=None, bufsize=65536):
+		if format not in self.formats:
+			raise ValueError('Unknown output format: ' + str(format) )
+		if stream is None:
+			stream = getattr(sys.stdout, 'buffer', sys.stdout)
+		self.format = format
+		self.stream = stream
+		self.bufsize = bufsize
+		self._buffer = []
+		self._buffered = 0
+	
+	def write(self, record):
+		'''Add record to the output, writing the output if the buffer is full.'''
+		if self.format == 'ndjson':
+			import json
+			data = [json.dumps(self._jsonRecord(record), sort_keys=True).encode('ascii') + b'\n']
+		elif 'paths' in record:
+			data = [_encodePath(x) + b'\0' for x in record['paths']]
+		else:
+			data = [_encodePath(record['path']) + b'\0']
+		self._buffer.extend(data)
+		self._buffered += sum(len(x) for x in data)
+		if self._buffered >= self.bufsize:
+			self.flush()
+	
+	def _jsonRecord(self, record):
+		'''Return a copy of record in which the path fields hold only text
+		that can be written as JSON, adding the raw bytes of any path that is
+		not valid UTF-8 in base64 encoded '_b64' fields.
+		'''
+		import base64
+		record = dict(record)
+		for key in self.pathFields:
+			if key not in record:
+				continue
+			islist = isinstance(record[key], list)
+			if islist:
+				raw = [_encodePath(x) for x in record[key]]
+			else:
+				raw = [_encodePath(record[key])]
+			try:
+				for x in raw:
+					x.decode('utf-8')
+			except UnicodeDecodeError:
+				text = [x.decode('utf-8', 'replace') for x in raw]
+				encoded = [base64.b64encode(x).decode('ascii') for x in raw]
+				if islist:
+					record[key] = text
+					record[key + '_b64'] = encoded
+				else:
+					record[key] = text[0]
+					record[key + '_b64'] = encoded[0]
+		return record
+	
+	def flush(self):
+		'''Write all buffered output to the stream.'''
+		self.stream.write(b''.join(self._buffer) )
+		self.stream.flush()
+		self._buffer = []
+		self._buffered = 0
+
+
+def _encodePath(path):
+	'''Return path as bytes in the file system encoding.'''
+	if isinstance(path, bytes):
+		return path
+	return path.encode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+class WalkFilter(object):
+	'''Rules for the files generated by walkfiles.  Names matching any of the
+	exclude glob patterns or excludeRegex regular expressions are skipped,
+	along with everything below them if they are directories.  If include
+	or includeRegex patterns are given, only files matching one of them are
+	kept.  Glob patterns containing a path separator are matched against the
+	path relative to the top directory, others against the base name;
+	regular expressions are searched for in the relative path.  Files larger
+	than maxsize (if it is not None) are skipped, as are directories on other
+	file systems if xdev is True, and files that are not regular files (such
+	as devices, sockets and pipes) if skipspecial is True.
+	'''
+	def __init__(self, include=(), exclude=(), includeRegex=(), excludeRegex=(),
+			maxsize=None, xdev=False, skipspecial=False):
+		import re
+		self.include = list(include)
+		self.exclude = list(exclude)
+		self.includeRegex = [re.compile(x) for x in includeRegex]
+		self.excludeRegex = [re.compile(x) for x in excludeRegex]
+		self.maxsize = maxsize
+		self.xdev = xdev
+		self.skipspecial = skipspecial
+	
+	def _matches(self, patterns, regexes, name, relname):
+		import fnmatch
+		for pattern in patterns:
+			if os.sep in pattern or (os.altsep and os.altsep in pattern):
+				if fnmatch.fnmatch(relname, pattern):
+					return True
+			elif fnmatch.fnmatch(name, pattern):
+				return True
+		for regex in regexes:
+			if regex.search(relname):
+				return True
+		return False
+	
+	def excluded(self, name, relname):
+		'''Return True if the file or directory name, at path relname relative
+		to the top directory, is excluded.
+		'''
+		return self._matches(self.exclude, self.excludeRegex, name, relname)
+	
+	def included(self, name, relname):
+		'''Return True if the file name, at path relname relative to the top
+		directory, is included.
+		'''
+		if not self.include and not self.includeRegex:
+			return True
+		return self._matches(self.include, self.includeRegex, name, relname)
+
+
+def patternList(value):
+	'''Return the patterns given by an include or exclude option as a list.
+	value may be a list, as collected from options repeated on the command
+	line, or a string from a configuration file holding one pattern per line.
+	'''
+	if not value:
+		return []
+	if isinstance(value, list):
+		return value
+	return [x.strip() for x in value.splitlines() if x.strip()]
+
+
+def _listdir(dirname):
+	'''Return a list of 2-tuples for the entries of directory dirname, each
+	containing the entry name and whether it is a directory, without
+	following symbolic links.  Where os.scandir is available this needs no
+	stat of the entries.
+	'''
+	scandir = getattr(os, 'scandir', None)
+	if scandir:
+		return [(x.name, x.is_dir(follow_symlinks=False) ) for x in scandir(dirname)]
+	entries = []
+	for name in os.listdir(dirname):
+		path = os.path.join(dirname, name)
+		entries.append( (name, os.path.isdir(path) and not os.path.islink(path) ) )
+	return entries
+
+
+def walkfiles(top, walkfilter=None, minsize=0):
+	'''Generate a 2-tuple (file name, stat) for each of the files within
+	directory top that os.walk would list, except files smaller than minsize
+	and those rejected by walkfilter.  The rules of walkfilter are applied as
+	the directories are listed, so excluded directories are never descended
+	into and excluded names are never stat'ed.
+	'''
+	import stat
+	if walkfilter is None:
+		walkfilter = WalkFilter()
+	top = os.path.abspath(top)
+	topdev = None
+	if walkfilter.xdev:
+		topdev = os.stat(top).st_dev
+	stack = [(top, '')]
+	while stack:
+		dirname, reldir = stack.pop()
+		try:
+			entries = _listdir(dirname)
+		except OSError:
+			# Can happen if user does not have permission to read the directory
+			continue
+		subdirs = []
+		for name, isdir in entries:
+			relname = os.path.join(reldir, name)
+			if walkfilter.excluded(name, relname):
+				continue
+			filename = os.path.join(dirname, name)
+			if isdir:
+				if topdev is None or os.lstat(filename).st_dev == topdev:
+					subdirs.append( (filename, relname) )
+				continue
+			if not walkfilter.included(name, relname):
+				continue
+			try:
+				st = os.stat(filename)
+			except OSError:
+				# Can happen if the file is deleted during the script run,
+				# or if a link points to a non-existent file
+				continue
+			if stat.S_ISDIR(st.st_mode):
+				# A link to a directory, which os.walk does not follow
+				continue
+			if walkfilter.skipspecial and not stat.S_ISREG(st.st_mode):
+				continue
+			if st.st_size < minsize:
+				continue
+			if walkfilter.maxsize is not None and st.st_size > walkfilter.maxsize:
+				continue
+			yield filename, st
+		subdirs.reverse()
+		stack.extend(subdirs)
+
+
+# Number of files gathered before their reads are scheduled together
+readBatch = 65536
@@ -22,10 +22,15 @@ except ImportError:
 	# Python 2
 	import ConfigParser
 
+import hashlib
 import os
 import sys
 import shutil
 
+from mergeutil import (externalsort, groupsorted, mergejoin, readscheduled,
+		readBatch, readSize, hashfile, Throttle, lowerIOPriority, RecordWriter,
+		WalkFilter, patternList, walkfiles)
+
 if sys.version < '3':
 	def text(x, e=sys.getfilesystemencoding() ):
 		# Convert data type to text type
@@ -88,35 +93,38 @@ def gensig(dirname):
 	contents (of size given by global variable _signatureSize, which
 	is set in this function) with the file size appended to its end.
 	'''
+	return list(itersig(dirname) )
+
+
+def itersig(dirname, maxreaders=0, throttle=None, walkfilter=None):
+	'''Return a generator of the same tuples that gensig lists, without
+	holding them all in memory.  Files are hashed in batches ordered by
+	readscheduled, with maxreaders concurrent reads per device, and read
+	through throttle if it is given.  Files rejected by walkfilter are
+	skipped during the directory walk.
+	'''
 	# To avoid reading all the files, the algorithm could use the
 	# file size as a signature, and only get the checksums of files
 	# that have duplicate file sizes (and have sizes > 0), but that
 	# requires the signature generation to stat all files in both
 	# directories first, then read the files later.
 	global _signatureSize
-	import hashlib
-	sig = []
-	newSig = hashlib.sha256
 	if _signatureSize == 0:
-		_signatureSize = len(newSig().hexdigest() )
-	for root, dirs, files in os.walk(dirname):
-		for name in files:
-			filename = os.path.abspath(os.path.join(root, name) )
-			size = os.stat(filename).st_size
-			try:
-				f = open(filename, 'rb')
-			except IOError:
-				# Can happen if the file is deleted during the script run, or if a link points to a non-existent file
-				continue
-			m = newSig()
-			while True:
-				c = f.read(1048576)
-				if not c:
-					break
-				m.update(c)
-			f.close()
-			sig.append( (str(m.hexdigest()) + str(size), filename) )
-	return sig
+		_signatureSize = len(hashlib.sha256().hexdigest() )
+	def readsig(filename, st):
+		digest = hashfile(filename, throttle)
+		if digest is None:
+			return None
+		return (str(digest) + str(st.st_size), filename)
+	pending = []
+	for filename, st in walkfiles(dirname, walkfilter):
+		pending.append( (filename, st) )
+		if len(pending) >= readBatch:
+			for sig in readscheduled(pending, readsig, maxreaders):
+				yield sig
+			pending = []
+	for sig in readscheduled(pending, readsig, maxreaders):
+		yield sig
 
 
 def duplicates(seqA, seqB):
@@ -145,14 +153,53 @@ def dupdict(seq):
 	return d
 
 
-def rmerge(aname, bname, interactive=False, suffix=''):
+def _pruneParents(filename, top):
+	'''Remove the directories containing filename, from the bottom up, for
+	as long as they are empty, stopping before directory top.
+	'''
+	top = os.path.abspath(top)
+	dirname = os.path.dirname(os.path.abspath(filename) )
+	while dirname != top and dirname.startswith(top):
+		try:
+			os.rmdir(dirname)
+		except OSError:
+			# Not empty
+			break
+		log.debug("Removing directory " + text(dirname) )
+		dirname = os.path.dirname(dirname)
+
+
+def _samecontents(aname, bname, throttle):
+	'''Return True if files aname and bname have the same contents, reading
+	them through throttle.
+	'''
+	if os.path.getsize(aname) != os.path.getsize(bname):
+		return False
+	with open(aname, 'rb') as a:
+		with open(bname, 'rb') as b:
+			offset = 0
+			while True:
+				adata = throttle.read(a, offset, readSize)
+				bdata = throttle.read(b, offset, readSize)
+				if adata != bdata:
+					return False
+				if not adata:
+					return True
+				offset += len(adata)
+
+
+def rmerge(aname, bname, interactive=False, suffix='', throttle=None, output=None):
 	'''Move all files from aname to bname, as long as that will not overwrite
 	an existing file.  If it would, handle the conflict interactively if
 	interactive is True, or append a suffix if suffix is not empty, or else
-	print the relative file name.
+	print the relative file name, or write it to RecordWriter output if that
+	is given.  Files are compared through throttle if it is given.
+	Subdirectories of aname that are left empty are removed along the way.
 	'''
 	if suffix and interactive:
 		raise ValueError('Only one of --interactive or --suffix may be specified')
+	if output and interactive:
+		raise ValueError('--interactive cannot be used with machine-readable output')
 	try:
 		if os.path.samefile(aname, bname):
 			log.error('Different directories must be specified')
@@ -163,62 +210,106 @@ def rmerge(aname, bname, interactive=False, suffix=''):
 		log.error('Two different directories must be specified')
 		return 22
 	
-	for fname in os.listdir(aname):
-		destfilename = os.path.abspath(os.path.join(bname, fname) )
-		if os.path.exists(destfilename):
-			srcfilename = os.path.abspath(os.path.join(aname, fname) )
-			if filecmp.cmp(srcfilename, destfilename, shallow=False):
-				log.debug("Removing file " + text(srcfilename) )
-				os.remove(srcfilename)
-			else:
-				if interactive:
-					import difflib
-					print('Conflict found with file ' + text(fname) )
-					with open(srcfilename, 'rb') as f:
-						srcstr = f.readlines()
-					with open(destfilename, 'rb') as f:
-						deststr = f.readlines()
-					for line in difflib.unified_diff(srcstr, deststr, srcfilename, destfilename):
-						sys.stdout.write(line)
-
-					a = raw_input("Which version of " + text(fname) + " would you like to keep? (+, -, o) ")
-					if a == '-':
-						log.debug("Moving file " + text(srcfilename) + " to " + text(destfilename) )
-						shutil.move(srcfilename, destfilename)
-					elif a == '+':
-						log.debug("Removing file " + text(srcfilename) )
-						os.remove(srcfilename)
-				elif suffix:
-					destfilename = text(destfilename)
-					while os.path.exists(destfilename):
-						destfilename += text(suffix)
-					log.debug("Moving file " + text(srcfilename) + " to " + destfilename)
-					shutil.move(srcfilename, destfilename )
+	# Count the entries left in each source directory as files are moved or
+	# removed, and remove each directory as soon as its count reaches zero,
+	# so that the source tree does not need to be walked again afterwards
+	top = os.path.abspath(aname)
+	remaining = {}
+	def settle(dirname):
+		while dirname != top and remaining[dirname] == 0:
+			del remaining[dirname]
+			log.debug("Removing directory " + text(dirname) )
+			os.rmdir(dirname)
+			dirname = os.path.dirname(dirname)
+			remaining[dirname] -= 1
+	
+	stack = ['']
+	while stack:
+		reldir = stack.pop()
+		srcdir = reldir and os.path.join(top, reldir) or top
+		names = os.listdir(srcdir)
+		remaining[srcdir] = len(names)
+		for name in names:
+			fname = os.path.join(reldir, name)
+			srcfilename = os.path.join(srcdir, name)
+			destfilename = os.path.abspath(os.path.join(bname, fname) )
+			if os.path.exists(destfilename):
+				if os.path.isdir(destfilename) and os.path.isdir(srcfilename) and not os.path.islink(srcfilename):
+					# Merge the contents of the directories
+					stack.append(fname)
+					continue
+				bothfiles = os.path.isfile(srcfilename) and os.path.isfile(destfilename)
+				if not bothfiles:
+					same = False
+				elif throttle:
+					same = _samecontents(srcfilename, destfilename, throttle)
 				else:
-					print(fname)
-		else:
-			srcfilename = os.path.abspath(os.path.join(aname, fname) )
-			if not os.path.exists(os.path.dirname(destfilename) ):
-				os.makedirs(os.path.dirname(destfilename) )
-			shutil.move(srcfilename, destfilename)
-
-	# Remove any remaining empty directories	
-	for root, dirs, files in walkslow(aname):
-		if root == aname: continue
-		if not dirs and not files:
-			os.rmdir(root)
+					same = filecmp.cmp(srcfilename, destfilename, shallow=False)
+				if same:
+					log.debug("Removing file " + text(srcfilename) )
+					os.remove(srcfilename)
+					remaining[srcdir] -= 1
+				else:
+					if interactive and bothfiles:
+						import difflib
+						print('Conflict found with file ' + text(fname) )
+						with open(srcfilename, 'rb') as f:
+							srcstr = f.readlines()
+						with open(destfilename, 'rb') as f:
+							deststr = f.readlines()
+						for line in difflib.unified_diff(srcstr, deststr, srcfilename, destfilename):
+							sys.stdout.write(line)
+
+						a = raw_input("Which version of " + text(fname) + " would you like to keep? (+, -, o) ")
+						if a == '-':
+							log.debug("Moving file " + text(srcfilename) + " to " + text(destfilename) )
+							shutil.move(srcfilename, destfilename)
+							remaining[srcdir] -= 1
+						elif a == '+':
+							log.debug("Removing file " + text(srcfilename) )
+							os.remove(srcfilename)
+							remaining[srcdir] -= 1
+					elif suffix:
+						destfilename = text(destfilename)
+						while os.path.exists(destfilename):
+							destfilename += text(suffix)
+						log.debug("Moving file " + text(srcfilename) + " to " + destfilename)
+						shutil.move(srcfilename, destfilename )
+						remaining[srcdir] -= 1
+					elif output:
+						output.write({'type': 'conflict', 'path': fname,
+								'size': os.path.getsize(srcfilename),
+								'destsize': os.path.getsize(destfilename)})
+					else:
+						print(fname)
+			else:
+				if not os.path.exists(os.path.dirname(destfilename) ):
+					os.makedirs(os.path.dirname(destfilename) )
+				shutil.move(srcfilename, destfilename)
+				remaining[srcdir] -= 1
+		settle(srcdir)
 	return
 
 
-def smerge(aname, bname, interactive=False, suffix='', commonsuffix=0, minsize=1):
+def smerge(aname, bname, interactive=False, suffix='', commonsuffix=0, minsize=1,
+		maxmemory=0, tmpdir=None, maxreaders=0, throttle=None, output=None,
+		walkfilter=None):
 	'''Move all files from aname to bname, as long as that will not overwrite
 	an existing file and there are no identical files already somewhere within
 	directory bname.  Otherwise, handle the conflict interactively if
 	interactive is True, or append a suffix if suffix is not empty, or else
-	print the relative file name.
+	print the relative file name.  If maxmemory is nonzero, find identical
+	files by sorting the signatures on disk in tmpdir, using about maxmemory
+	bytes of memory for each directory.  Files are hashed with maxreaders
+	concurrent reads per device and read through throttle, as in itersig.
+	If output is an ndjson RecordWriter, each removed file is also written
+	to it with its size, signature and the file it matched.  Files rejected
+	by walkfilter are not searched in either directory.
 	'''
 	if suffix and interactive:
 		raise ValueError('Only one of --interactive or --suffix may be specified')
+	if output and interactive:
+		raise ValueError('--interactive cannot be used with machine-readable output')
 	try:
 		if os.path.samefile(aname, bname):
 			log.error('Different directories must be specified')
@@ -228,22 +319,27 @@ def smerge(aname, bname, interactive=False, suffix='', commonsuffix=0, minsize=1
 	if aname=='' or bname == '' or aname == bname:
 		log.error('Two different directories must be specified')
 		return 22
-	asig = gensig(aname)
-	bsig = gensig(bname)
+	asig = itersig(aname, maxreaders, throttle, walkfilter)
+	bsig = itersig(bname, maxreaders, throttle, walkfilter)
 
 	# Remove duplicate files from directory bname
-	adict = dupdict(asig)
-	bdict = dupdict(bsig)
-	for item in duplicates(adict, bdict):
+	if maxmemory:
+		groups = mergejoin(groupsorted(externalsort(asig, maxmemory, tmpdir) ),
+				groupsorted(externalsort(bsig, maxmemory, tmpdir) ) )
+	else:
+		adict = dupdict(asig)
+		bdict = dupdict(bsig)
+		groups = ( (item, adict[item], bdict[item]) for item in duplicates(adict, bdict) )
+	for item, afiles, bfiles in groups:
 		asize = int(item[_signatureSize:] )
-		for x in adict[item]:
+		for x in afiles:
 			xl = split_path(x)
 			xl.reverse();
 			if asize < minsize:
 				commonSuffix = len(os.path.split(relpath(x, aname) ) ) - 1
 			else:
 				commonSuffix = commonsuffix
-			for y in bdict[item]:
+			for y in bfiles:
 				suffixmatch = 0
 				yl = split_path(y)
 				yl.reverse()
@@ -255,6 +351,11 @@ def smerge(aname, bname, interactive=False, suffix='', commonsuffix=0, minsize=1
 				if suffixmatch >= commonSuffix:
 					log.debug(x + ' = ' + y)
 					os.remove(x)
+					_pruneParents(x, aname)
+					if output and output.format == 'ndjson':
+						output.write({'type': 'removed', 'path': relpath(x, aname),
+								'match': relpath(y, bname), 'size': asize,
+								'digest': item[:_signatureSize]})
 					break
 	
 	# Now that all duplicate files have been removed from directory aname,
@@ -262,45 +363,7 @@ def smerge(aname, bname, interactive=False, suffix='', commonsuffix=0, minsize=1
 	# an existing file.  If it would, print the conflicting file by default,
 	# and use future command-line options to resolve the conflict differently.
 	# We can just run the non-searching rmerge algorithm to do that.
-	return rmerge(aname, bname, interactive, suffix)
-
-
-def walkslow(top):
-	'''Walk a directory like os.walk, but monitor the directory for changes
-	that may be made by the caller after visiting the directory.  This was
-	inspired by the posix command "find -depth"
-	'''
-	# os.walk from python 2.7 was referred to in this implementation
-	valid = True
-	try:
-		names = os.listdir(top)
-	except Exception:
-		# Can happen if user does not have permission to read the directory
-		return
-	dirs, nondirs = [], []
-	for name in names:
-		if os.path.isdir(os.path.join(top, name)):
-			dirs.append(name)
-		else:
-			nondirs.append(name)
-	
-	for name in dirs:
-		new_path = os.path.join(top, name)
-		if not os.path.islink(new_path):
-			valid = False
-			for x in deepwalk(new_path):
-				yield x
-	
-	if not valid:
-		names = os.listdir(top)
-		dirs, nondirs = [], []
-		for name in names:
-			if os.path.isdir(os.path.join(top, name)):
-				dirs.append(name)
-			else:
-				nondirs.append(name)
-	
-	yield top, dirs, nondirs
+	return rmerge(aname, bname, interactive, suffix, throttle, output)
 
 
 def relpath(path, start=os.curdir):
@@ -420,9 +483,43 @@ def run_cli(argv=None):
 	clparser.add_option('-s', '--search', dest='search',
 			help='Search for identical files in the destination directory.  If found, discard the source file.',
 			action='store_true')
+	clparser.add_option('--format', dest='format', metavar='FORMAT',
+			help='Set output format: text, ndjson (one JSON object per conflict or removed file; a path that is not valid UTF-8 has its raw bytes added base64 encoded in path_b64 or match_b64) or null (name of each conflicting file followed by a NUL character) (default text)',
+			type='choice', choices=['text', 'ndjson', 'null'])
 	clparser.add_option('--suffix', dest='suffix', metavar='SUFFIX',
 			help='Copy conflicting files to destination directory after appending the specified suffix',
 			type='str')
+	clparser.add_option('--max', dest='maxsize', metavar='SIZE',
+			help='Set maximum size of files to search for identical files (default no limit)',
+			type='int')
+	clparser.add_option('--include', dest='include', metavar='GLOB', action='append',
+			help='Only search for identical files among files matching GLOB; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--exclude', dest='exclude', metavar='GLOB', action='append',
+			help='Do not search files or directories matching GLOB for identical files; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--include-regex', dest='includeregex', metavar='REGEX', action='append',
+			help='Only search for identical files among files whose relative path matches REGEX; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('--exclude-regex', dest='excluderegex', metavar='REGEX', action='append',
+			help='Do not search files or directories whose relative path matches REGEX for identical files; may be given more than once, or one per line in the configuration file')
+	clparser.add_option('-x', '--xdev', dest='xdev', action='store_true',
+			help='Do not search directories on other file systems for identical files')
+	clparser.add_option('--skip-special', dest='skipspecial', action='store_true',
+			help='Do not search files that are not regular files, such as devices and pipes, for identical files')
+	clparser.add_option('--max-memory', dest='maxmemory', metavar='MB',
+			help='Limit memory used by --search to about MB megabytes per directory by sorting on disk (default 0; 0 means no limit)',
+			type='int')
+	clparser.add_option('--tmpdir', dest='tmpdir', metavar='DIR',
+			help='Set directory for temporary files written when --max-memory is given')
+	clparser.add_option('--readers', dest='maxreaders', metavar='NUM',
+			help='Set number of files read at once from each device by --search (default 0; 0 means 1 for spinning disks and 4 for solid state devices)',
+			type='int')
+	clparser.add_option('--background', dest='background', action='store_true',
+			help='Drop scanned files from the page cache and lower the I/O priority, to run alongside other programs')
+	clparser.add_option('--max-rate', dest='maxrate', metavar='MB',
+			help='Limit reading files to MB megabytes per second (default 0; 0 means no limit)',
+			type='float')
+	clparser.add_option('--max-iops', dest='maxiops', metavar='NUM',
+			help='Limit reading files to NUM reads per second (default 0; 0 means no limit)',
+			type='float')
 
 	clparser.set_defaults(filename = _qualname_ + '.cfg')
 	(options, args) = clparser.parse_args(argv)
@@ -487,12 +584,41 @@ def run_cli(argv=None):
 	if o['interactive']: kwargs['interactive'] = o['interactive']
 	if o['suffix']: kwargs['suffix'] = o['suffix']
 	if o['minsize'] != None: kwargs['minsize'] = o['minsize']
+	if o['background'] and not lowerIOPriority():
+		log.warning('Unable to lower the I/O priority on this system')
+	if o['background'] or o['maxrate'] or o['maxiops']:
+		kwargs['throttle'] = Throttle(float(o['maxrate'] or 0) * 1048576,
+				float(o['maxiops'] or 0), bool(o['background']) )
+	
+	if o['format'] and o['format'] != 'text':
+		if o['interactive']:
+			# The prompts and diffs would be mixed into the machine-readable output
+			log.error('--interactive cannot be used with --format ' + o['format'])
+			return 22
+		kwargs['output'] = RecordWriter(o['format'])
 	
 	# Configuration has completed; run the application
-	if o['search']:
-		smerge(*args, **kwargs)
-	else:
-		rmerge(*args, **kwargs)
+	try:
+		if o['search']:
+			if o['maxmemory']: kwargs['maxmemory'] = int(o['maxmemory']) * 1048576
+			if o['tmpdir']: kwargs['tmpdir'] = o['tmpdir']
+			if o['maxreaders']: kwargs['maxreaders'] = int(o['maxreaders'])
+			if (o['maxsize'] != None or o['include'] or o['exclude'] or o['includeregex']
+					or o['excluderegex'] or o['xdev'] or o['skipspecial']):
+				if o['maxsize'] != None:
+					maxsize = int(o['maxsize'])
+				else:
+					maxsize = None
+				kwargs['walkfilter'] = WalkFilter(patternList(o['include']),
+						patternList(o['exclude']), patternList(o['includeregex']),
+						patternList(o['excluderegex']), maxsize,
+						bool(o['xdev']), bool(o['skipspecial']) )
+			smerge(*args, **kwargs)
+		else:
+			rmerge(*args, **kwargs)
+	finally:
+		if 'output' in kwargs:
+			kwargs['output'].flush()
 	return 0
 
 
@@ -44,12 +44,33 @@ export INTERACTIVE
 # To escape a single quote within a single-quoted string,
 # replace each occurrence of  '  with  '\''
 # Then nothing else needs to be escaped further.
-find "$SRC" -type f -exec sh -c '
+# Directories are removed as soon as they are left empty, from the bottom up,
+# so "$SRC" does not need to be searched again for empty directories.
+# find passes the files of a directory together, so removal is only tried
+# once the files of a directory are done, when the next file is in another
+# directory or at the end of the batch.  Directories that are empty from the
+# start are passed in by find.
+find "$SRC" \( -type f -o -type d -empty \) -exec sh -c '
+	prune() {
+		dir="$1"
+		while [ -n "$dir" ] && rmdir "$SRC/$dir" 2>/dev/null; do
+			case "$dir" in
+				*/* ) dir="${dir%/*}" ;;
+				* ) dir="" ;;
+			esac
+		done
+	}
+	lastdir=""
 	for fullfile in "$@" ; do
 		escsrc=`echo "$SRC" | sed -e '\''s@[]/$*.^+|[-]@\\&@g'\'' -`
 		file=`echo "$fullfile" | sed -e '\"'s/$escsrc\/\{0,1\}//'\"' -`
 		printFilename=`printf '\''%s'\'' "$file" | LC_ALL=POSIX tr -d '\''[:cntrl:]'\'' `
-		if [ -e "$DEST/$file" ]; then
+		if [ -z "$file" ]; then
+			continue
+		elif [ -d "$SRC/$file" ]; then
+			prune "$file"
+			continue
+		elif [ -e "$DEST/$file" ]; then
 			cmp -s "$SRC/$file" "$DEST/$file"
 			ret="$?"
 			if [ "$ret" = "1" ]; then
@@ -75,15 +96,15 @@ find "$SRC" -type f -exec sh -c '
 			mkdir -p "`dirname "$DEST/$file"`"
 			mv "$SRC/$file" "$DEST/$file"
 		fi
-	done
-' sh {} '+'
-
-# Delete all empty directories contained within "$SRC"
-find "$SRC" -depth -type d -empty -exec sh -c '
-	for file in "$@" ; do
-		if [ -e "$file" ] && [ "$file" != "$SRC" ]; then
-			rm -r "$file"
+		case "$file" in
+			*/* ) filedir="${file%/*}" ;;
+			* ) filedir="" ;;
+		esac
+		if [ "$filedir" != "$lastdir" ]; then
+			prune "$lastdir"
+			lastdir="$filedir"
 		fi
 	done
+	prune "$lastdir"
 ' sh {} '+'
 